@@ -0,0 +1,207 @@
+# This script is used to pre encode the imagenet webdataset shards with a frozen VQ model.
+#
+# The VQ model is never trained in `training/train_maskgit_imagenet.py`, so running its
+# encoder on every training step is redundant work. This script runs it once and writes
+# one output shard per input shard, with the same keys, containing
+#
+#   - `{vq_checkpoint}.pth`: the int16 image token ids of shape (seq_len,)
+#   - `cls`: the imagenet class id
+#
+# where `vq_checkpoint` is the lowercased model id with `/` replaced by `.`, e.g.
+# `openmuse.maskgit-vqgan-imagenet-f16-256.pth`. Train on the result by passing
+# `training.pre_encode=True` and pointing `dataset.params.*_shards_path_or_url` at the
+# output shards.
+#
+# Example:
+#
+# python scripts/pre_encode_imagenet.py \
+#     --shards "pipe:aws s3 cp s3://muse-datasets/imagenet-wds/imagenet-train-{000000..000320}.tar -" \
+#     --upload_to s3://muse-datasets/imagenet-wds-pre-encoded
+
+import argparse
+import logging
+import os
+import re
+
+import torch
+import torchvision.transforms.functional as TF
+import webdataset as wds
+from torch.utils.data import DataLoader
+from torchvision.transforms import InterpolationMode
+
+from muse import MOVQ, MaskGitVQGAN
+
+torch.set_float32_matmul_precision("high")
+
+MASKGIT_VQGAN_IMAGENET = "openMUSE/maskgit-vqgan-imagenet-f16-256"
+
+logger = logging.getLogger(__name__)
+
+tar_regex = r"\/([^\/]+\.tar)"
+
+
+def get_tar_file_name(url):
+    match = re.search(tar_regex, url)
+    assert match is not None, url
+    tar_file_name = match.group(1)
+    return tar_file_name
+
+
+def get_vq_model_class(model_type):
+    if model_type == "movq":
+        return MOVQ
+    elif model_type == "maskgit_vqgan":
+        return MaskGitVQGAN
+    else:
+        raise ValueError(f"model_type {model_type} not supported for VQGAN")
+
+
+def transform(image, resolution):
+    # Same as the eval transform of `ImageNetTransform` in `training/data.py`, we always center crop
+    # so that the pre-encoded tokens are deterministic.
+    image = TF.resize(image, size=resolution, interpolation=InterpolationMode.BILINEAR)
+    image = TF.center_crop(image, resolution)
+    image = TF.to_tensor(image)
+    return image
+
+
+class Writers:
+    """
+    Keeps one tar writer open per input shard. The input shards are read sequentially, so the
+    previous writer is closed as soon as a sample from a new shard is seen.
+    """
+
+    def __init__(self, upload_to, skip_upload):
+        self.upload_to = upload_to
+        self.skip_upload = skip_upload
+        self.tar_file_name = None
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.writer is not None:
+            self.writer.close()
+        return False
+
+    def write(self, __url__, sample):
+        if self.skip_upload:
+            return
+
+        tar_file_name = get_tar_file_name(__url__)
+
+        if tar_file_name != self.tar_file_name:
+            if self.writer is not None:
+                self.writer.close()
+
+            if self.upload_to.startswith("s3://"):
+                upload_command = f"pipe:aws s3 cp - {self.upload_to}/{tar_file_name}"
+            else:
+                os.makedirs(self.upload_to, exist_ok=True)
+                upload_command = os.path.join(self.upload_to, tar_file_name)
+            logger.warning(f"opening new writer for {upload_command}")
+
+            self.writer = wds.TarWriter(upload_command)
+            self.tar_file_name = tar_file_name
+
+        self.writer.write(sample)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--shards",
+        type=str,
+        help="The webdataset shards to pre-encode, e.g. a brace expanded `pipe:aws s3 cp ...` url.",
+        required=True,
+    )
+    parser.add_argument(
+        "--upload_to",
+        type=str,
+        help="Where to write the pre-encoded shards. Either an `s3://` prefix or a local directory.",
+        required=True,
+    )
+    parser.add_argument(
+        "--vq_model_type",
+        type=str,
+        choices=["maskgit_vqgan", "movq"],
+        required=False,
+        default="maskgit_vqgan",
+    )
+    parser.add_argument(
+        "--vq_model", type=str, help="The pretrained VQ model to encode with", default=MASKGIT_VQGAN_IMAGENET
+    )
+    parser.add_argument(
+        "--batch_size", type=int, help="The batch size to encode at a time", required=False, default=256
+    )
+    parser.add_argument(
+        "--resolution", type=int, help="The resolution to convert the image to.", required=False, default=256
+    )
+    parser.add_argument(
+        "--skip_upload",
+        action="store_true",
+        help="Set to not actually upload results, helpful for only testing encoding.",
+    )
+
+    args = parser.parse_args()
+
+    if args.batch_size < 1:
+        raise ValueError("`--batch_size` must be >= 1")
+
+    if args.resolution < 1:
+        raise ValueError("`--resolution` must be >= 1")
+
+    vq_ext = f"{args.vq_model.lower().replace('/', '.')}.pth"
+
+    logger.warning("********************")
+    logger.warning("Pre-encoding imagenet")
+    logger.warning(f"shards: {args.shards}")
+    logger.warning(f"upload_to: {args.upload_to}")
+    logger.warning(f"vq_model: {args.vq_model}")
+    logger.warning(f"batch_size: {args.batch_size}")
+    logger.warning("********************")
+
+    vq_model = get_vq_model_class(args.vq_model_type).from_pretrained(args.vq_model)
+    vq_model.to("cuda")
+    vq_model.requires_grad_(False)
+    vq_model.eval()
+
+    # A single background worker reads the shards in order so that each output shard is written
+    # by one writer, while still overlapping decoding with encoding on the gpu.
+    src = (
+        wds.WebDataset(args.shards)
+        .decode("pil", handler=wds.warn_and_continue)
+        .rename(image="jpg;png;jpeg;webp", class_id="cls")
+        .map_dict(image=lambda image: transform(image, args.resolution), class_id=lambda x: int(x))
+        .to_tuple("__key__", "__url__", "image", "class_id")
+        .batched(args.batch_size, partial=True)
+    )
+    src = DataLoader(
+        src,
+        batch_size=None,
+        shuffle=False,
+        num_workers=1,
+        pin_memory=True,
+    )
+
+    with Writers(args.upload_to, args.skip_upload) as writers, torch.inference_mode():
+        for __key__, __url__, image, class_id in src:
+            logger.warning(f"Encoding {len(__key__)} examples: {__key__[0]} to {__key__[-1]}.")
+
+            image = image.to("cuda", non_blocking=True)
+            image_tokens = vq_model.encode(image)[1]
+            # codebook ids are < 2**15, so int16 is enough and 4x smaller on disk than int64
+            image_tokens = image_tokens.to(torch.int16).cpu()
+
+            for __key__, __url__, image_tokens_, class_id_ in zip(__key__, __url__, image_tokens, class_id):
+                sample = {
+                    "__key__": __key__,
+                    vq_ext: image_tokens_.clone(),
+                    "cls": int(class_id_),
+                }
+                writers.write(__url__, sample)
+
+
+if __name__ == "__main__":
+    main()
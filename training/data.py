@@ -26,11 +26,14 @@ from functools import partial
 from typing import List, Optional, Union
 
 import PIL
+import torch
 import webdataset as wds
 import yaml
 from braceexpand import braceexpand
 from torch.utils.data import default_collate
 from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_image
+from torchvision.transforms import v2
 from transformers import PreTrainedTokenizer
 from webdataset.tariterators import (
     base_plus_ext,
@@ -114,21 +117,42 @@ def get_aesthetic_score(json):
     return a
 
 
+def decode_image_tensor(data):
+    """Decodes encoded image bytes to a uint8 (3, H, W) tensor with torchvision.io, skipping PIL."""
+    try:
+        return decode_image(torch.frombuffer(bytearray(data), dtype=torch.uint8), mode=ImageReadMode.RGB)
+    except RuntimeError:
+        # fallback for the formats torchvision.io can't decode
+        with io.BytesIO(data) as stream:
+            image = PIL.Image.open(stream).convert("RGB")
+        return v2.functional.pil_to_tensor(image)
+
+
+def collate_image_and_class_id(samples):
+    """Collates `(image, class_id)` samples, building the class ids with a single `torch.as_tensor` call."""
+    images, class_ids = zip(*samples)
+    # default_collate stacks the images directly into shared memory when running in a dataloader worker
+    return default_collate(images), torch.as_tensor(class_ids, dtype=torch.long)
+
+
 class ImageNetTransform:
+    # the transforms work on both PIL images and uint8 tensors, tensors are faster as they skip PIL
     def __init__(self, resolution, center_crop=True, random_flip=False):
-        self.train_transform = transforms.Compose(
+        self.train_transform = v2.Compose(
             [
-                transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR),
-                (transforms.CenterCrop(resolution) if center_crop else transforms.RandomCrop(resolution)),
-                transforms.RandomHorizontalFlip() if random_flip else transforms.Lambda(lambda x: x),
-                transforms.ToTensor(),
+                v2.ToImage(),
+                v2.Resize(resolution, interpolation=v2.InterpolationMode.BILINEAR, antialias=True),
+                (v2.CenterCrop(resolution) if center_crop else v2.RandomCrop(resolution)),
+                v2.RandomHorizontalFlip() if random_flip else v2.Identity(),
+                v2.ToDtype(torch.float32, scale=True),
             ]
         )
-        self.eval_transform = transforms.Compose(
+        self.eval_transform = v2.Compose(
             [
-                transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR),
-                transforms.CenterCrop(resolution),
-                transforms.ToTensor(),
+                v2.ToImage(),
+                v2.Resize(resolution, interpolation=v2.InterpolationMode.BILINEAR, antialias=True),
+                v2.CenterCrop(resolution),
+                v2.ToDtype(torch.float32, scale=True),
             ]
         )
 
@@ -164,11 +188,33 @@ class ClassificationDataset:
         shuffle_buffer_size: int = 1000,
         pin_memory: bool = False,
         persistent_workers: bool = False,
+        prefetch_factor: Optional[int] = None,
+        num_interleaved_shards: int = 1,
+        is_pre_encoded: bool = False,
+        vq_checkpoint: Optional[str] = None,
         **kwargs,
     ):
         transform = ImageNetTransform(resolution, center_crop, random_flip)
+        # number of batches each worker loads in advance, only valid with worker processes
+        loader_kwargs = {"prefetch_factor": prefetch_factor} if prefetch_factor and num_workers > 0 else {}
 
-        if return_text:
+        if is_pre_encoded:
+            if return_text:
+                raise ValueError("return_text is not supported with pre-encoded image tokens")
+            if vq_checkpoint is None:
+                raise ValueError("vq_checkpoint must be provided when is_pre_encoded is True")
+
+            # lowercase and replace / with .
+            vq_checkpoint = vq_checkpoint.lower().replace("/", ".")
+            processing_pipeline = [
+                wds.decode(wds.handle_extension("pth", wds.autodecode.torch_loads), handler=wds.ignore_and_continue),
+                wds.rename(image_input_ids=f"{vq_checkpoint}.pth", class_id="cls", handler=wds.warn_and_continue),
+                wds.map(filter_keys(set(["image_input_ids", "class_id"]))),
+                wds.map_dict(class_id=lambda x: int(x)),
+                wds.to_tuple("image_input_ids", "class_id"),
+            ]
+            collation_fn = collate_image_and_class_id
+        elif return_text:
             if imagenet_class_mapping_path is None:
                 raise ValueError("imagenet_class_mapping_path must be provided when return_text is True")
 
@@ -183,6 +229,8 @@ class ClassificationDataset:
                 return input_ids[0]
 
             processing_pipeline = [
+                # only decodes the metadata, images are decoded to tensors below
+                wds.decode(handler=wds.ignore_and_continue),
                 wds.rename(
                     image="jpg;png;jpeg;webp",
                     input_ids="cls",
@@ -191,6 +239,7 @@ class ClassificationDataset:
                     handler=wds.warn_and_continue,
                 ),
                 wds.map(filter_keys(set(["image", "input_ids", "text_raw", "class_idx"]))),
+                wds.map_dict(image=decode_image_tensor, handler=wds.ignore_and_continue),
                 wds.map_dict(
                     image=transform.train_transform,
                     input_ids=tokenize,
@@ -198,22 +247,42 @@ class ClassificationDataset:
                 ),
                 wds.to_tuple("image", "input_ids"),
             ]
+            collation_fn = default_collate
         else:
             processing_pipeline = [
+                # only decodes the metadata, images are decoded to tensors below
+                wds.decode(handler=wds.ignore_and_continue),
                 wds.rename(image="jpg;png;jpeg;webp", class_id="cls", handler=wds.warn_and_continue),
                 wds.map(filter_keys(set(["image", "class_id"]))),
+                wds.map_dict(image=decode_image_tensor, handler=wds.ignore_and_continue),
                 wds.map_dict(image=transform.train_transform, class_id=lambda x: int(x)),
                 wds.to_tuple("image", "class_id"),
             ]
+            collation_fn = collate_image_and_class_id
 
         # Create train dataset and loader
+        if num_interleaved_shards > 1:
+            # Read from several shards at the same time in each worker, so that streaming one shard overlaps with
+            # reading the others. The shards are resampled, so each of these streams is infinite.
+            shard_streams = [
+                wds.DataPipeline(
+                    wds.ResampledShards(train_shards_path_or_url),
+                    wds.tarfile_to_samples(handler=wds.ignore_and_continue),
+                )
+                for _ in range(num_interleaved_shards)
+            ]
+            source = [wds.RandomMix(shard_streams)]
+        else:
+            source = [
+                wds.ResampledShards(train_shards_path_or_url),
+                wds.tarfile_to_samples(handler=wds.ignore_and_continue),
+            ]
+
         pipeline = [
-            wds.ResampledShards(train_shards_path_or_url),
-            wds.tarfile_to_samples(handler=wds.ignore_and_continue),
+            *source,
             wds.shuffle(shuffle_buffer_size),
-            wds.decode("pil", handler=wds.ignore_and_continue),
             *processing_pipeline,
-            wds.batched(per_gpu_batch_size, partial=False, collation_fn=default_collate),
+            wds.batched(per_gpu_batch_size, partial=False, collation_fn=collation_fn),
         ]
 
         num_batches = math.ceil(num_train_examples / global_batch_size)
@@ -230,6 +299,7 @@ class ClassificationDataset:
             num_workers=num_workers,
             pin_memory=pin_memory,
             persistent_workers=persistent_workers,
+            **loader_kwargs,
         )
         # add meta-data to dataloader instance for convenience
         self._train_dataloader.num_batches = num_batches
@@ -240,9 +310,8 @@ class ClassificationDataset:
             wds.SimpleShardList(eval_shards_path_or_url),
             wds.split_by_worker,
             wds.tarfile_to_samples(handler=wds.ignore_and_continue),
-            wds.decode("pil", handler=wds.ignore_and_continue),
             *processing_pipeline,
-            wds.batched(per_gpu_batch_size, partial=True, collation_fn=default_collate),
+            wds.batched(per_gpu_batch_size, partial=True, collation_fn=collation_fn),
         ]
         self._eval_dataset = wds.DataPipeline(*pipeline)
         self._eval_dataloader = wds.WebLoader(
@@ -252,6 +321,7 @@ class ClassificationDataset:
             num_workers=num_workers,
             pin_memory=pin_memory,
             persistent_workers=persistent_workers,
+            **loader_kwargs,
         )
 
     @property
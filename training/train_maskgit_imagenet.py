@@ -13,13 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import inspect
 import json
 import logging
 import math
 import os
 import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, List, Tuple
+from typing import Any, List, Tuple, Union
 
 import numpy as np
 import torch
@@ -29,7 +31,7 @@ from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import DistributedType, set_seed
 from data import ClassificationDataset
-from omegaconf import DictConfig, ListConfig, OmegaConf
+from omegaconf import OmegaConf
 from optimizer import Lion
 from PIL import Image
 from torch.optim import AdamW  # why is shampoo not available in PT :(
@@ -59,33 +61,23 @@ def get_config():
 
 
 def flatten_omega_conf(cfg: Any, resolve: bool = False) -> List[Tuple[str, Any]]:
+    # convert to plain python containers once, so interpolations are only resolved a single time
+    container = OmegaConf.to_container(cfg, resolve=resolve)
     ret = []
 
-    def handle_dict(key: Any, value: Any, resolve: bool) -> List[Tuple[str, Any]]:
-        return [(f"{key}.{k1}", v1) for k1, v1 in flatten_omega_conf(value, resolve=resolve)]
-
-    def handle_list(key: Any, value: Any, resolve: bool) -> List[Tuple[str, Any]]:
-        return [(f"{key}.{idx}", v1) for idx, v1 in flatten_omega_conf(value, resolve=resolve)]
-
-    if isinstance(cfg, DictConfig):
-        for k, v in cfg.items_ex(resolve=resolve):
-            if isinstance(v, DictConfig):
-                ret.extend(handle_dict(k, v, resolve=resolve))
-            elif isinstance(v, ListConfig):
-                ret.extend(handle_list(k, v, resolve=resolve))
-            else:
-                ret.append((str(k), v))
-    elif isinstance(cfg, ListConfig):
-        for idx, v in enumerate(cfg._iter_ex(resolve=resolve)):
-            if isinstance(v, DictConfig):
-                ret.extend(handle_dict(idx, v, resolve=resolve))
-            elif isinstance(v, ListConfig):
-                ret.extend(handle_list(idx, v, resolve=resolve))
-            else:
-                ret.append((str(idx), v))
-    else:
-        assert False
+    def walk(prefix: str, value: Any):
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            ret.append((prefix, value))
+            return
+
+        for k, v in items:
+            walk(f"{prefix}.{k}" if prefix else str(k), v)
 
+    walk("", container)
     return ret
 
 
@@ -117,6 +109,22 @@ def soft_target_cross_entropy(logits, targets, soft_targets):
     return loss
 
 
+def to_device(pixel_values_or_image_ids, device):
+    # images are moved to channels last to match the memory format of the vq model, pre-encoded image ids are 2D
+    if pixel_values_or_image_ids.ndim == 4:
+        return pixel_values_or_image_ids.to(device, non_blocking=True, memory_format=torch.channels_last)
+    return pixel_values_or_image_ids.to(device, non_blocking=True)
+
+
+def compute_loss(model, input_ids, labels, soft_targets=None, label_smoothing=0.0):
+    if soft_targets is not None:
+        logits = model(input_ids=input_ids)
+        return soft_target_cross_entropy(logits, labels, soft_targets)
+
+    _, loss = model(input_ids=input_ids, labels=labels, label_smoothing=label_smoothing)
+    return loss
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
 
@@ -136,31 +144,136 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class ThroughputMeter(object):
+    """Measures the samples per second of a window with cuda events, so the queued gpu work is also counted"""
+
+    def __init__(self, device):
+        self.use_cuda_events = torch.device(device).type == "cuda"
+        self.reset()
+
+    def reset(self):
+        self.num_samples = 0
+        if self.use_cuda_events:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        else:
+            self.start = time.time()
+
+    def update(self, n):
+        self.num_samples += n
+
+    def samples_per_second(self):
+        # time.time() only measures how fast the host enqueues work, so wait for the gpu to finish the window
+        if self.use_cuda_events:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            end.synchronize()
+            elapsed = self.start.elapsed_time(end) / 1000
+        else:
+            elapsed = time.time() - self.start
+        return self.num_samples / elapsed
+
+
+@dataclass
+class InputBuffers:
+    """Tensors reused across steps to mask the image tokens and build the inputs and labels in place"""
+
+    timestep_ids: torch.LongTensor
+    rand: torch.FloatTensor
+    mask: torch.BoolTensor
+    input_ids: torch.LongTensor
+    labels: torch.LongTensor
+
+    @classmethod
+    def create(cls, batch_size, seq_len, device):
+        input_ids = torch.empty(batch_size, seq_len + 1, dtype=torch.long, device=device)
+        labels = torch.empty_like(input_ids)
+        # we don't want to predict the class ids
+        labels[:, 0] = -100
+        return cls(
+            timestep_ids=torch.empty(batch_size, dtype=torch.long, device=device),
+            rand=torch.empty(batch_size, seq_len, device=device),
+            mask=torch.empty(batch_size, seq_len, dtype=torch.bool, device=device),
+            input_ids=input_ids,
+            labels=labels,
+        )
+
+
+def build_inputs(image_tokens, class_ids, buffers, mask_schedule, min_masking_rate, mask_id, class_id_offset):
+    """
+    Mask the image tokens and write the input ids and labels into `buffers`. Everything stays on the gpu with static
+    shapes, so this can be compiled into a few fused kernels.
+    """
+    # TODO(Patrick) - I don't think that's how the timesteps are sampled in maskgit or MUSE
+    # Sample a random (quantized) timestep for each image
+    timestep_ids = buffers.timestep_ids.random_(0, mask_schedule.shape[0] - 1)
+    # Look up the mask probability for each image from the precomputed cosine schedule
+    mask_prob = mask_schedule[timestep_ids]
+    mask_prob = mask_prob.clamp_(min=min_masking_rate)
+    # creat a random mask for each image
+    # A Bernoulli mask with the per image mask probability. The number of masked tokens varies slightly around
+    # `seq_len * mask_prob` instead of being exact, but sampling an exact count would need a `.item()` host sync
+    # on every step to size the topk, which would stall the gpu and break cuda graph capture.
+    rand = buffers.rand.uniform_()
+    mask = torch.lt(rand, mask_prob.unsqueeze(-1), out=buffers.mask)
+    # always mask at least one token per image so that every image contributes to the loss, the smallest noise
+    # position is already masked whenever any token is, so this only changes rows with no masked tokens
+    mask.scatter_(1, rand.argmin(dim=-1, keepdim=True), True)
+    # mask images and create input and labels, the class ids go in front of the image tokens
+    input_ids, labels = buffers.input_ids, buffers.labels
+    # shift the class ids by codebook size
+    input_ids[:, 0] = class_ids + class_id_offset
+    input_ids[:, 1:].copy_(image_tokens).masked_fill_(mask, mask_id)
+    # the mask buffer is not needed anymore, so invert it in place to mask the labels
+    labels[:, 1:].copy_(image_tokens).masked_fill_(mask.logical_not_(), -100)
+    return input_ids, labels, mask_prob
+
+
 def main():
     #########################
     # SETUP Accelerator     #
     #########################
     config = get_config()
 
+    # Let the caching allocator grow segments in place instead of allocating new ones, this avoids fragmentation
+    # and cudaMalloc/cudaFree stalls. Must be set before the first cuda allocation. Note that expandable segments
+    # don't work with cudaIpcGetMemHandle, which we don't use.
+    if config.training.get("expandable_segments", True):
+        alloc_conf = os.environ.get("PYTORCH_CUDA_ALLOC_CONF", "")
+        if "expandable_segments" not in alloc_conf:
+            alloc_conf = ",".join(filter(None, [alloc_conf, "expandable_segments:True"]))
+            os.environ["PYTORCH_CUDA_ALLOC_CONF"] = alloc_conf
+
     # Enable TF32 on Ampere GPUs
     if config.training.enable_tf32:
         torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
         torch.backends.cudnn.benchmark = True
         torch.backends.cudnn.deterministic = False
 
+    # Merge `effective_micro_merge` gradient accumulation micro-batches into a single larger batch. The total batch
+    # size stays the same, but each step runs fewer, larger kernels which helps small models that are launch bound.
+    micro_merge = config.training.get("effective_micro_merge", 1)
+    if micro_merge < 1 or config.training.gradient_accumulation_steps % micro_merge != 0:
+        raise ValueError(
+            f"effective_micro_merge ({micro_merge}) must be >= 1 and divide gradient_accumulation_steps"
+            f" ({config.training.gradient_accumulation_steps})"
+        )
+    per_gpu_batch_size = config.training.batch_size * micro_merge
+    gradient_accumulation_steps = config.training.gradient_accumulation_steps // micro_merge
+
     config.experiment.logging_dir = str(Path(config.experiment.output_dir) / "logs")
     accelerator = Accelerator(
-        gradient_accumulation_steps=config.training.gradient_accumulation_steps,
-        mixed_precision=config.training.mixed_precision,
+        gradient_accumulation_steps=gradient_accumulation_steps,
+        # bf16 is the default, it has the same exponent range as fp32 and so doesn't need a grad scaler
+        mixed_precision=config.training.get("mixed_precision", "bf16"),
         log_with="wandb",
         logging_dir=config.experiment.logging_dir,
         split_batches=True,  # It's important to set this to True when using webdataset to get the right number of steps for lr scheduling. If set to False, the number of steps will be devide by the number of processes assuming batches are multiplied by the number of processes.
     )
 
     if accelerator.distributed_type == DistributedType.DEEPSPEED:
-        accelerator.state.deepspeed_plugin.deepspeed_config["train_micro_batch_size_per_gpu"] = (
-            config.training.batch_size
-        )
+        accelerator.state.deepspeed_plugin.deepspeed_config["train_micro_batch_size_per_gpu"] = per_gpu_batch_size
 
     #####################################
     # SETUP LOGGING, SEED and CONFIG    #
@@ -172,6 +285,8 @@ def main():
         level=logging.INFO,
     )
     logger.info(accelerator.state, main_process_only=False)
+    if accelerator.mixed_precision == "fp16" and torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        logger.warning("Training in fp16 on a gpu that supports bf16, bf16 is faster as it doesn't need loss scaling.")
     if accelerator.is_local_main_process:
         muse.logging.set_verbosity_info()
     else:
@@ -217,10 +332,16 @@ def main():
     #########################
     logger.info("Loading models and optimizer")
 
+    is_pre_encode = config.training.get("pre_encode", False)
+    if is_pre_encode and config.training.use_soft_code_target:
+        raise ValueError("use_soft_code_target is not supported with pre-encoded image tokens")
+
     vq_class = get_vq_model_class(config.model.vq_model.type)
     vq_model = vq_class.from_pretrained(config.model.vq_model.pretrained)
     model = MaskGitTransformer(**config.model.transformer)
     mask_id = model.config.mask_token_id
+    # class ids are shifted by the codebook size so they don't collide with the image tokens
+    num_vq_embeddings = vq_model.config.num_embeddings
 
     # Freeze the VQGAN
     vq_model.requires_grad_(False)
@@ -239,12 +360,27 @@ def main():
             * config.training.gradient_accumulation_steps
         )
 
+    # Update all the params with a single fused kernel (or a few multi-tensor kernels when fused is not available)
+    # instead of looping over the params in python. Before torch 2.4 the fused AdamW only accepts cuda params, so
+    # move the model to the device before creating the optimizer and only use fused when the params are on cuda.
+    model.to(accelerator.device)
+    optimizer_kwargs = {}
+    if "fused" in inspect.signature(AdamW).parameters and all(p.is_cuda for p in model.parameters()):
+        torch_adamw_kwargs = {"fused": True}
+    else:
+        torch_adamw_kwargs = {"foreach": True}
+
     optimizer_type = config.optimizer.name
     if optimizer_type == "adamw":
         optimizer_cls = AdamW
+        optimizer_kwargs = torch_adamw_kwargs
     elif optimizer_type == "fused_adamw":
         if is_apex_available:
             optimizer_cls = apex.optimizers.FusedAdam
+        elif "fused" in torch_adamw_kwargs:
+            logger.warning("apex is not installed, using the fused AdamW from PyTorch instead")
+            optimizer_cls = AdamW
+            optimizer_kwargs = torch_adamw_kwargs
         else:
             raise ImportError("Please install apex to use fused_adam")
     elif optimizer_type == "lion":
@@ -258,6 +394,7 @@ def main():
         betas=(optimizer_config.beta1, optimizer_config.beta2),
         weight_decay=optimizer_config.weight_decay,
         eps=optimizer_config.epsilon,
+        **optimizer_kwargs,
     )
 
     ##################################
@@ -265,10 +402,8 @@ def main():
     #################################
     logger.info("Creating dataloaders and lr_scheduler")
 
-    total_batch_size_without_accum = config.training.batch_size * accelerator.num_processes
-    total_batch_size = (
-        config.training.batch_size * accelerator.num_processes * config.training.gradient_accumulation_steps
-    )
+    total_batch_size_without_accum = per_gpu_batch_size * accelerator.num_processes
+    total_batch_size = per_gpu_batch_size * accelerator.num_processes * gradient_accumulation_steps
 
     # DataLoaders creation:
     # We use webdataset for data loading. The dataloaders are created with sampling with replacement.
@@ -276,11 +411,16 @@ def main():
     # This means that the dataloading is not deterministic, but it's fast and efficient.
     preproc_config = config.dataset.preprocessing
     dataset_config = config.dataset.params
+    if not is_pre_encode and dataset_config.num_workers < 4:
+        logger.warning(
+            f"Using only {dataset_config.num_workers} dataloader workers, decoding imagenet images will likely be"
+            " the bottleneck. Use at least 4 workers per gpu."
+        )
     dataset = ClassificationDataset(
         train_shards_path_or_url=dataset_config.train_shards_path_or_url,
         eval_shards_path_or_url=dataset_config.eval_shards_path_or_url,
         num_train_examples=config.experiment.max_train_examples,
-        per_gpu_batch_size=config.training.batch_size,
+        per_gpu_batch_size=per_gpu_batch_size,
         global_batch_size=total_batch_size_without_accum,
         num_workers=dataset_config.num_workers,
         resolution=preproc_config.resolution,
@@ -289,6 +429,10 @@ def main():
         shuffle_buffer_size=dataset_config.shuffle_buffer_size,
         pin_memory=dataset_config.pin_memory,
         persistent_workers=dataset_config.persistent_workers,
+        prefetch_factor=dataset_config.get("prefetch_factor", None),
+        num_interleaved_shards=dataset_config.get("num_interleaved_shards", 1),
+        is_pre_encoded=is_pre_encode,
+        vq_checkpoint=config.model.vq_model.pretrained,
     )
     train_dataloader, eval_dataloader = dataset.train_dataloader, dataset.eval_dataloader
 
@@ -303,13 +447,43 @@ def main():
     logger.info("Preparing model, optimizer and dataloaders")
     # The dataloader are already aware of distributed training, so we don't need to prepare them.
     model, optimizer, lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
-    vq_model.to(accelerator.device)
+
+    # Compile the transformer forward to fuse the small elementwise kernels and, with `reduce-overhead`, replay it
+    # with cuda graphs. Shapes are static since the train dataloader drops the last partial batch.
+    # The un-compiled `model` is still used for checkpointing and generation.
+    use_cuda_graphs = config.training.get("use_cuda_graphs", False)
+    use_torch_compile = config.training.get("use_torch_compile", False)
+    torch_compile_mode = config.training.get("torch_compile_mode", "reduce-overhead")
+    if use_torch_compile and use_cuda_graphs:
+        logger.warning(
+            "`use_torch_compile` takes precedence over `use_cuda_graphs`, cuda graphs are only recorded by the"
+            f" `reduce-overhead` and `max-autotune` compile modes, got `{torch_compile_mode}`"
+        )
+    if use_torch_compile:
+        compiled_model = torch.compile(model, mode=torch_compile_mode, fullgraph=False, dynamic=False)
+    elif use_cuda_graphs:
+        # Only capture the forward and backward of the transformer in cuda graphs, without inductor's kernel fusion.
+        # Each graph is recorded after a warmup run and then replayed with a single launch. The masking and the
+        # optimizer step stay eager, as the lr of the optimizer changes every step from python.
+        compiled_model = torch.compile(model, backend="cudagraphs", fullgraph=False, dynamic=False)
+    else:
+        compiled_model = model
+    # `use_cuda_graphs` and the `reduce-overhead` and `max-autotune` compile modes all record cuda graphs. The last
+    # eval batch can be partial, so evaluate eagerly instead of recompiling and recording a graph for every batch size
+    records_cuda_graphs = use_cuda_graphs or (
+        use_torch_compile and torch_compile_mode in ("reduce-overhead", "max-autotune")
+    )
+    eval_model = model if records_cuda_graphs else compiled_model
+    # With pre-encoded image tokens the vq model is only needed to decode generated images on the main process
+    if not is_pre_encode or accelerator.is_main_process:
+        # cudnn convolutions are faster in NHWC
+        vq_model.to(accelerator.device, memory_format=torch.channels_last)
 
     if config.training.overfit_one_batch:
         train_dataloader = [next(iter(train_dataloader))]
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
-    num_update_steps_per_epoch = math.ceil(train_dataloader.num_batches / config.training.gradient_accumulation_steps)
+    num_update_steps_per_epoch = math.ceil(train_dataloader.num_batches / gradient_accumulation_steps)
     # Afterwards we recalculate our number of training epochs.
     # Note: We are not doing epoch based training here, but just using this for book keeping and being able to
     # reuse the same training loop with other datasets/loaders.
@@ -318,8 +492,8 @@ def main():
     # Train!
     logger.info("***** Running training *****")
     logger.info(f"  Num training steps = {config.training.max_train_steps}")
-    logger.info(f"  Gradient Accumulation steps = {config.training.gradient_accumulation_steps}")
-    logger.info(f"  Instantaneous batch size per device = { config.training.batch_size}")
+    logger.info(f"  Gradient Accumulation steps = {gradient_accumulation_steps}")
+    logger.info(f"  Instantaneous batch size per device = {per_gpu_batch_size}")
     logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
     global_step = 0
     first_epoch = 0
@@ -354,56 +528,70 @@ def main():
             global_step = int(os.path.basename(path).split("-")[1])
             first_epoch = global_step // num_update_steps_per_epoch
 
+    # The cosine schedule is evaluated once on quantized timesteps, so each step only needs a gather instead of
+    # recomputing it. With 1024 steps the timesteps are off by less than 1e-3.
+    num_schedule_steps = 1024
+    mask_schedule = cosine_schedule(torch.linspace(0, 1, num_schedule_steps + 1, device=accelerator.device))
+    # The masking prefix is a chain of small elementwise kernels, fuse it too. It mutates its input buffers, so it is
+    # compiled in the default mode, as cuda graphs would be skipped for mutated inputs anyway.
+    build_inputs_fn = build_inputs
+    if use_torch_compile:
+        build_inputs_fn = torch.compile(build_inputs, fullgraph=False, dynamic=False)
+
+    # The random noise, mask, input ids and labels are written in place into buffers that are allocated once per
+    # shape, instead of allocating fresh tensors and concatenating the class ids every step.
+    input_buffers = {}
+
     @torch.no_grad()
     def prepare_inputs_and_labels(
-        pixel_values: torch.FloatTensor,
+        pixel_values_or_image_ids: Union[torch.FloatTensor, torch.LongTensor],
         class_ids: torch.LongTensor,
         min_masking_rate: float = 0.0,
         is_train: bool = True,
     ):
-        if config.training.use_soft_code_target and is_train:
+        if is_pre_encode:
+            # image tokens are stored as int16 on disk
+            image_tokens = pixel_values_or_image_ids.long()
+            soft_targets = None
+        elif config.training.use_soft_code_target and is_train:
             soft_targets, image_tokens = vq_model.get_soft_code(
-                pixel_values, temp=config.training.soft_code_temp, stochastic=config.training.use_stochastic_code
+                pixel_values_or_image_ids,
+                temp=config.training.soft_code_temp,
+                stochastic=config.training.use_stochastic_code,
             )
         else:
-            image_tokens = vq_model.encode(pixel_values)[1]
+            # The image tokens are only copied into the input and label buffers below, so they never need autograd.
+            # The soft targets above stay under no_grad, as the loss saves them for backward and inference tensors
+            # can't be saved.
+            with torch.inference_mode():
+                image_tokens = vq_model.encode(pixel_values_or_image_ids)[1]
             soft_targets = None
 
         batch_size, seq_len = image_tokens.shape
-        # TODO(Patrick) - I don't think that's how the timesteps are sampled in maskgit or MUSE
-        # Sample a random timestep for each image
-        timesteps = torch.rand(batch_size, device=image_tokens.device)
-        # Sample a random mask probability for each image using timestep and cosine schedule
-        mask_prob = cosine_schedule(timesteps)
-        mask_prob = mask_prob.clip(min_masking_rate)
-        # creat a random mask for each image
-        num_token_masked = (seq_len * mask_prob).round().clamp(min=1)
-        batch_randperm = torch.rand(batch_size, seq_len, device=image_tokens.device).argsort(dim=-1)
-        mask = batch_randperm < num_token_masked.unsqueeze(-1)
-        # mask images and create input and labels
-        input_ids = torch.where(mask, mask_id, image_tokens)
-        labels = torch.where(mask, image_tokens, -100)
-
-        # shift the class ids by codebook size
-        class_ids = class_ids + vq_model.num_embeddings
-        # prepend the class ids to the image tokens
-        input_ids = torch.cat([class_ids.unsqueeze(-1), input_ids], dim=-1)
-        # prepend -100 to the labels as we don't want to predict the class ids
-        labels_mask = torch.ones_like(class_ids, device=image_tokens.device).unsqueeze(-1).fill_(-100)
-        labels = torch.cat([labels_mask, labels], dim=-1)
+        if (batch_size, seq_len) not in input_buffers:
+            input_buffers[(batch_size, seq_len)] = InputBuffers.create(batch_size, seq_len, image_tokens.device)
+        buffers = input_buffers[(batch_size, seq_len)]
+
+        input_ids, labels, mask_prob = build_inputs_fn(
+            image_tokens, class_ids, buffers, mask_schedule, min_masking_rate, mask_id, num_vq_embeddings
+        )
         return input_ids, labels, soft_targets, mask_prob
 
     batch_time_m = AverageMeter()
     data_time_m = AverageMeter()
+    running_loss = torch.zeros((), device=accelerator.device)
+    running_masking_rate = torch.zeros((), device=accelerator.device)
+    running_count = 0
+    throughput_m = ThroughputMeter(accelerator.device)
     end = time.time()
     # As stated above, we are not doing epoch based training here, but just using this for book keeping and being able to
     # reuse the same training loop with other datasets/loaders.
     for epoch in range(first_epoch, num_train_epochs):
         model.train()
         for batch in train_dataloader:
-            # TODO(Patrick) - We could definitely pre-compute the image tokens for faster training on larger datasets
+            # pixel_values are the pre-encoded image tokens when training with `training.pre_encode`
             pixel_values, class_ids = batch
-            pixel_values = pixel_values.to(accelerator.device, non_blocking=True)
+            pixel_values = to_device(pixel_values, accelerator.device)
             class_ids = class_ids.to(accelerator.device, non_blocking=True)
             data_time_m.update(time.time() - end)
 
@@ -419,48 +607,49 @@ def main():
 
             # Train Step
             with accelerator.accumulate(model):
-                if config.training.use_soft_code_target:
-                    logits = model(input_ids=input_ids)
-                    loss = soft_target_cross_entropy(logits, labels, soft_targets)
-                else:
-                    _, loss = model(
-                        input_ids=input_ids, labels=labels, label_smoothing=config.training.label_smoothing
-                    )
-                # Gather thexd losses across all processes for logging (if we use distributed training).
-                avg_loss = accelerator.gather(loss.repeat(config.training.batch_size)).mean()
-                avg_masking_rate = accelerator.gather(mask_prob.repeat(config.training.batch_size)).mean()
+                loss = compute_loss(
+                    compiled_model, input_ids, labels, soft_targets, label_smoothing=config.training.label_smoothing
+                )
+                # Accumulate the losses for logging, they are only reduced across processes when we log
+                running_loss += loss.detach()
+                running_masking_rate += mask_prob.mean()
+                running_count += 1
 
                 accelerator.backward(loss)
 
-                if config.training.max_grad_norm is not None and accelerator.sync_gradients:
-                    accelerator.clip_grad_norm_(model.parameters(), config.training.max_grad_norm)
+                # Only update the weights once the gradients of all the accumulation steps have been synced
+                if accelerator.sync_gradients:
+                    if config.training.max_grad_norm is not None:
+                        accelerator.clip_grad_norm_(model.parameters(), config.training.max_grad_norm)
 
-                optimizer.step()
-                lr_scheduler.step()
+                    optimizer.step()
+                    lr_scheduler.step()
 
-                # log gradient norm before zeroing it
-                if (
-                    accelerator.sync_gradients
-                    and (global_step + 1) % config.experiment.log_grad_norm_every == 0
-                    and accelerator.is_main_process
-                ):
-                    log_grad_norm(model, accelerator, global_step + 1)
+                    # log gradient norm before zeroing it
+                    if (global_step + 1) % config.experiment.log_grad_norm_every == 0 and accelerator.is_main_process:
+                        log_grad_norm(model, accelerator, global_step + 1)
 
-                if optimizer_type == "fused_adamw":
-                    optimizer.zero_grad()
-                else:
-                    optimizer.zero_grad(set_to_none=True)
+                    if optimizer_type == "fused_adamw" and is_apex_available:
+                        optimizer.zero_grad()
+                    else:
+                        optimizer.zero_grad(set_to_none=True)
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
                 batch_time_m.update(time.time() - end)
                 end = time.time()
+                throughput_m.update(gradient_accumulation_steps * per_gpu_batch_size)
 
                 # Log metrics
                 if (global_step + 1) % config.experiment.log_every == 0:
-                    samples_per_second_per_gpu = (
-                        config.training.gradient_accumulation_steps * config.training.batch_size / batch_time_m.val
-                    )
+                    # Average over the log window and across all processes (if we use distributed training).
+                    avg_loss = accelerator.reduce(running_loss / running_count, reduction="mean")
+                    avg_masking_rate = accelerator.reduce(running_masking_rate / running_count, reduction="mean")
+                    running_loss.zero_()
+                    running_masking_rate.zero_()
+                    running_count = 0
+
+                    samples_per_second_per_gpu = throughput_m.samples_per_second()
                     logs = {
                         "step_loss": avg_loss.item(),
                         "lr": lr_scheduler.get_last_lr()[0],
@@ -482,18 +671,24 @@ def main():
                     # resetting batch / data time meters per log window
                     batch_time_m.reset()
                     data_time_m.reset()
+                    throughput_m.reset()
 
                 # Evaluate model on main process
                 if (global_step + 1) % config.experiment.eval_every == 0 and accelerator.is_main_process:
-                    validate_model(model, eval_dataloader, accelerator, global_step + 1, prepare_inputs_and_labels)
+                    validate_model(
+                        eval_model, eval_dataloader, accelerator, global_step + 1, prepare_inputs_and_labels
+                    )
+                    throughput_m.reset()
 
                 # Save model checkpoint
                 if (global_step + 1) % config.experiment.save_every == 0:
                     save_checkpoint(model, config, accelerator, global_step + 1)
+                    throughput_m.reset()
 
                 # Generate images
                 if (global_step + 1) % config.experiment.generate_every == 0 and accelerator.is_main_process:
                     generate_images(model, vq_model, accelerator, global_step + 1)
+                    throughput_m.reset()
 
                 global_step += 1
                 # TODO: Add generation
@@ -507,7 +702,7 @@ def main():
 
     # Evaluate and save checkpoint at the end of training
     if accelerator.is_main_process:
-        validate_model(model, eval_dataloader, accelerator, global_step, prepare_inputs_and_labels)
+        validate_model(eval_model, eval_dataloader, accelerator, global_step, prepare_inputs_and_labels)
     save_checkpoint(model, config, accelerator, global_step)
 
     # Save the final trained checkpoint
@@ -518,24 +713,26 @@ def main():
     accelerator.end_training()
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def validate_model(model, eval_dataloader, accelerator, global_step, prepare_inputs_and_labels):
     logger.info("Evaluating...")
     model.eval()
-    eval_loss = 0
+    # the losses are summed on the device and only synced with the host once at the end
+    eval_loss = torch.zeros((), device=accelerator.device)
+    num_batches = 0
     now = time.time()
-    for i, batch in enumerate(eval_dataloader):
+    for batch in eval_dataloader:
         pixel_values, class_ids = batch
-        pixel_values = pixel_values.to(accelerator.device, non_blocking=True)
+        pixel_values = to_device(pixel_values, accelerator.device)
         class_ids = class_ids.to(accelerator.device, non_blocking=True)
         input_ids, labels, _, _ = prepare_inputs_and_labels(pixel_values, class_ids, is_train=False)
-        _, loss = model(input_ids=input_ids, labels=labels)
-        eval_loss += loss.mean()
-    eval_loss = eval_loss / (i + 1)
+        eval_loss += compute_loss(model, input_ids, labels)
+        num_batches += 1
+    eval_loss = (eval_loss / max(num_batches, 1)).item()
     eval_time = time.time() - now
 
-    logger.info(f"Step: {global_step} Eval Loss: {eval_loss.item():0.4f} Eval time: {eval_time:0.2f} s")
-    accelerator.log({"eval_loss": eval_loss.item()}, step=global_step)
+    logger.info(f"Step: {global_step} Eval Loss: {eval_loss:0.4f} Eval time: {eval_time:0.2f} s")
+    accelerator.log({"eval_loss": eval_loss}, step=global_step)
     model.train()
 
 